@@ -1,64 +1,181 @@
 import os
+from dotenv import load_dotenv
+
+# Loaded before the gevent check so USE_GEVENT can also be set in .env
+load_dotenv()
+
+# Must run before anything imports socket/ssl (groq, redis, celery) so the web process's blocking I/O
+# (Redis enqueues and result polls, Batch API calls) yields the greenlet instead of tying up the worker
+if os.getenv('USE_GEVENT', '').lower() in ('1', 'true', 'yes'):
+    from gevent import monkey
+    monkey.patch_all()
+
 import csv
 import json
+import hashlib
+import time
+import queue
+import asyncio
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, flash, redirect, url_for, send_file
-from groq import Groq
-from dotenv import load_dotenv
+from flask import Flask, render_template, request, jsonify, flash, redirect, url_for, Response
+from groq import Groq, AsyncGroq, BadRequestError, RateLimitError
+from celery import Celery
+from celery.result import AsyncResult
+import redis
+import orjson
 from werkzeug.utils import secure_filename
-
-load_dotenv()
+from asgiref.wsgi import WsgiToAsgi
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
-# Initialize Groq client with error handling
+# Analyses run on Celery workers so HTTP requests return immediately
+celery = Celery(
+    app.import_name,
+    broker=os.getenv('CELERY_BROKER_URL', 'redis://localhost:6379/0'),
+    backend=os.getenv('CELERY_RESULT_BACKEND', 'redis://localhost:6379/0')
+)
+
+# Worker threads per Celery worker process; the micro-batcher allows the same number of Groq calls in flight
+WORKER_CONCURRENCY = int(os.getenv('WORKER_CONCURRENCY', '16'))
+celery.conf.worker_concurrency = WORKER_CONCURRENCY
+
+# Initialize Groq clients with error handling.
+# GROQ_API_KEYS (comma-separated) spreads calls across several rate-limit buckets;
+# otherwise the single GROQ_API_KEY is used.
+clients = []
 try:
-    api_key = os.getenv('GROQ_API_KEY')
-    if api_key:
-        api_key = api_key.strip().strip("'\"")  # Remove quotes if present
-        client = Groq(api_key=api_key)
-        print(f"Groq client initialized successfully with key: {api_key[:10]}...")
+    api_keys = os.getenv('GROQ_API_KEYS', '').split(',')
+    api_keys = [k.strip().strip("'\"") for k in api_keys]  # Remove quotes if present
+    api_keys = [k for k in api_keys if k]
+    if not api_keys and os.getenv('GROQ_API_KEY'):
+        api_keys = [os.getenv('GROQ_API_KEY').strip().strip("'\"")]
+
+    if api_keys:
+        clients = [Groq(api_key=k) for k in api_keys]
+        for k in api_keys:
+            print(f"Groq client initialized successfully with key: {k[:10]}...")
     else:
         print("Warning: GROQ_API_KEY not found in environment variables")
-        client = None
 except Exception as e:
     print(f"Error initializing Groq client: {str(e)}")
-    client = None
+    clients = []
 
-def analyze_transcript(transcript):
-    try:
-        # Check if client is available
-        if client is None:
-            print("Error: Groq client not initialized")
-            return "Error: Groq client not initialized", "Error: Groq client not initialized"
+# Optional shared analysis cache for multi-worker deploys; without it each process keeps its own LRU
+cache_url = os.getenv('ANALYSIS_CACHE_URL')
+analysis_cache = redis.Redis.from_url(cache_url) if cache_url else None
+ANALYSIS_CACHE_TTL = 86400  # 24 hours
 
-        print("Starting transcript analysis...")
+_rr_counter = itertools.count()
 
-        summary_prompt = f"""
-        You are an expert customer service analyst. Summarize the following customer service conversation in exactly 2-3 sentences. Focus on the main issue, actions taken, and outcome.
+def get_client():
+    if not clients:
+        return None
+    if len(clients) == 1:
+        return clients[0]
+    return clients[next(_rr_counter) % len(clients)]
+
+# Long transcripts are cut to head + tail windows: openings and resolutions carry the most signal
+TRANSCRIPT_HEAD_CHARS = 4000
+TRANSCRIPT_TAIL_CHARS = 2000
+
+def _window(transcript, head=TRANSCRIPT_HEAD_CHARS, tail=TRANSCRIPT_TAIL_CHARS):
+    if len(transcript) <= head + tail:
+        return transcript
+    return transcript[:head] + "\n...[middle elided]...\n" + transcript[-tail:]
+
+def _windowed_len(transcript):
+    return min(len(transcript), TRANSCRIPT_HEAD_CHARS + TRANSCRIPT_TAIL_CHARS)
+
+SENTIMENT_LABELS = [
+    "Satisfied and Positive",
+    "Frustrated and Negative",
+    "Confused and Negative",
+    "Disappointed and Negative",
+    "Impatient and Negative",
+    "Relieved and Positive",
+    "Grateful and Positive",
+    "Neutral and Cautious",
+    "Mixed and Neutral",
+]
+
+def _validate_sentiment(sentiment):
+    # Anything outside the fixed label set would leak free text into the CSV and history filters
+    if sentiment not in SENTIMENT_LABELS:
+        raise ValueError(f"Unexpected sentiment label: {sentiment!r}")
+    return sentiment
+
+def _combined_request_body(transcript):
+    # Single request: the transcript is sent once and both results come back as JSON
+    combined_prompt = f"""
+        You are an expert customer service analyst. Analyze the following customer service conversation.
 
         Customer Service Conversation:
-        {transcript}
+        {_window(transcript)}
 
-        Summary (2-3 sentences only):
+        Instructions:
+        - "summary": summarize the conversation in exactly 2-3 sentences. Focus on the main issue, actions taken, and outcome.
+        - "sentiment": the CUSTOMER's overall sentiment throughout the conversation (not the agent's), considering the entire conversation.
+
+        Choose the sentiment from these specific categories:
+        - "Satisfied and Positive" - Issue resolved, customer happy/grateful
+        - "Frustrated and Negative" - Customer angry, unresolved issues
+        - "Confused and Negative" - Customer lost, getting poor help
+        - "Disappointed and Negative" - Customer let down by service
+        - "Impatient and Negative" - Customer annoyed by delays/process
+        - "Relieved and Positive" - Problem solved after difficulty
+        - "Grateful and Positive" - Customer appreciative of help
+        - "Neutral and Cautious" - Customer uncertain about outcome
+        - "Mixed and Neutral" - Customer has both positive and negative feelings
         """
 
-        print("Making summary API call...")
-        summary_response = client.chat.completions.create(
-            messages=[{"role": "user", "content": summary_prompt}],
-            model="llama-3.1-8b-instant",
-            temperature=0.3,
-        )
+    return {
+        "messages": [
+            {
+                "role": "system",
+                "content": 'Return ONLY valid JSON: {"summary": "...", "sentiment": "<one of the 9 labels>"}'
+            },
+            {"role": "user", "content": combined_prompt}
+        ],
+        "model": "llama-3.1-8b-instant",
+        "temperature": 0.2,
+        "response_format": {"type": "json_object"},
+    }
+
+def _parse_combined(content):
+    data = json.loads(content)
+    return str(data['summary']).strip(), _validate_sentiment(str(data['sentiment']).strip())
+
+def _analyze_combined(transcript):
+    print("Making combined summary/sentiment API call...")
+    response = get_client().chat.completions.create(**_combined_request_body(transcript))
+
+    summary, sentiment = _parse_combined(response.choices[0].message.content)
+
+    print(f"Summary generated: {summary[:100]}...")
+    print(f"Sentiment analyzed: '{sentiment}'")
+
+    return summary, sentiment
+
+async def _analyze_separately_async(transcript):
+    summary_prompt = f"""
+        You are an expert customer service analyst. Summarize the following customer service conversation in exactly 2-3 sentences. Focus on the main issue, actions taken, and outcome.
+
+        Customer Service Conversation:
+        {_window(transcript)}
 
-        summary = summary_response.choices[0].message.content.strip()
-        print(f"Summary generated: {summary[:100]}...")
+        Summary (2-3 sentences only):
+        """
 
-        sentiment_prompt = f"""
+    sentiment_prompt = f"""
         You are an expert sentiment analyst. Analyze the CUSTOMER's overall sentiment throughout this conversation and provide a descriptive sentiment label.
 
         Customer Service Conversation:
-        {transcript}
+        {_window(transcript)}
 
         Instructions:
         - Focus ONLY on the customer's sentiment, not the agent's
@@ -76,93 +193,380 @@ def analyze_transcript(transcript):
         - "Neutral and Cautious" - Customer uncertain about outcome
         - "Mixed and Neutral" - Customer has both positive and negative feelings
 
-        Customer Sentiment (respond with exactly one phrase from above):
+        Respond with JSON containing only the "sentiment" field, set to exactly one phrase from above.
         """
 
-        print("Making sentiment API call...")
-        sentiment_response = client.chat.completions.create(
-            messages=[{"role": "user", "content": sentiment_prompt}],
-            model="llama-3.1-8b-instant",
-            temperature=0.1,
+    # Issue both calls concurrently so latency is max(summary, sentiment) rather than the sum.
+    # The async client is scoped to this event loop since asyncio.run() creates a new loop per call.
+    print("Making summary and sentiment API calls concurrently...")
+    async with AsyncGroq(api_key=get_client().api_key) as aclient:
+        summary_response, sentiment_response = await asyncio.gather(
+            aclient.chat.completions.create(
+                messages=[{"role": "user", "content": summary_prompt}],
+                model="llama-3.1-8b-instant",
+                temperature=0.3,
+            ),
+            aclient.chat.completions.create(
+                messages=[{"role": "user", "content": sentiment_prompt}],
+                model="llama-3.1-8b-instant",
+                temperature=0.1,
+                max_tokens=20,
+                response_format={"type": "json_object"},
+            ),
         )
 
-        sentiment = sentiment_response.choices[0].message.content.strip()
+    summary = summary_response.choices[0].message.content.strip()
+    print(f"Summary generated: {summary[:100]}...")
+
+    # json_object mode can't enforce an enum, so the label is checked here instead of cleaned up
+    sentiment = _validate_sentiment(str(json.loads(sentiment_response.choices[0].message.content)['sentiment']).strip())
+
+    print(f"Sentiment analyzed: '{sentiment}'")
+
+    return summary, sentiment
+
+def _is_json_validate_failed(error):
+    # In JSON mode Groq rejects invalid model output with a 400 rather than returning it
+    body = error.body if isinstance(error.body, dict) else {}
+    details = body.get('error') if isinstance(body.get('error'), dict) else body
+    return getattr(error, 'code', None) == 'json_validate_failed' or details.get('code') == 'json_validate_failed'
+
+def _analyze_single(transcript):
+    try:
+        return _analyze_combined(transcript)
+    except (KeyError, TypeError, ValueError) as e:
+        # Model returned something other than the expected JSON object (JSONDecodeError is a ValueError)
+        print(f"Combined response could not be parsed ({str(e)}), falling back to separate calls")
+    except BadRequestError as e:
+        if not _is_json_validate_failed(e):
+            raise
+        print(f"Combined response failed JSON validation ({str(e)}), falling back to separate calls")
+
+    return asyncio.run(_analyze_separately_async(transcript))
+
+def _analyze_many(transcripts):
+    numbered = "\n\n".join(
+        f"Transcript {i}:\n{_window(transcript)}" for i, transcript in enumerate(transcripts, start=1)
+    )
 
-        # Clean up sentiment response - remove quotes and extra text
-        sentiment_clean = sentiment.replace('"', '').replace("'", "").strip()
+    batch_prompt = f"""
+        You are an expert customer service analyst. Here are {len(transcripts)} customer service conversations. Analyze each one independently.
 
-        # If the response contains multiple lines, take the first one
-        if '\n' in sentiment_clean:
-            sentiment_clean = sentiment_clean.split('\n')[0].strip()
+        {numbered}
+
+        Instructions for each transcript:
+        - "summary": summarize the conversation in exactly 2-3 sentences. Focus on the main issue, actions taken, and outcome.
+        - "sentiment": the CUSTOMER's overall sentiment throughout the conversation (not the agent's), considering the entire conversation.
+
+        Choose the sentiment from these specific categories:
+        - "Satisfied and Positive" - Issue resolved, customer happy/grateful
+        - "Frustrated and Negative" - Customer angry, unresolved issues
+        - "Confused and Negative" - Customer lost, getting poor help
+        - "Disappointed and Negative" - Customer let down by service
+        - "Impatient and Negative" - Customer annoyed by delays/process
+        - "Relieved and Positive" - Problem solved after difficulty
+        - "Grateful and Positive" - Customer appreciative of help
+        - "Neutral and Cautious" - Customer uncertain about outcome
+        - "Mixed and Neutral" - Customer has both positive and negative feelings
+        """
 
-        # Extract only the core sentiment phrase (e.g., "Frustrated and Negative")
-        # Remove any extra explanatory text after the sentiment
-        if ':' in sentiment_clean:
-            sentiment_clean = sentiment_clean.split(':')[-1].strip()
+    print(f"Making batched summary/sentiment API call for {len(transcripts)} transcripts...")
+    response = get_client().chat.completions.create(
+        messages=[
+            {
+                "role": "system",
+                "content": 'Return ONLY valid JSON: {"results": [{"id": <transcript number>, "summary": "...", "sentiment": "<one of the 9 labels>"}, ...]} with one entry per transcript, in order.'
+            },
+            {"role": "user", "content": batch_prompt}
+        ],
+        model="llama-3.1-8b-instant",
+        temperature=0.2,
+        response_format={"type": "json_object"},
+    )
+
+    data = json.loads(response.choices[0].message.content)
+    by_id = {int(item['id']): item for item in data['results']}
+
+    # Raises KeyError/ValueError if the model dropped a transcript or invented a label,
+    # which triggers the per-transcript fallback
+    return [
+        (str(by_id[i]['summary']).strip(), _validate_sentiment(str(by_id[i]['sentiment']).strip()))
+        for i in range(1, len(transcripts) + 1)
+    ]
+
+# Micro-batching: transcripts arriving within MAX_WAIT_MS of each other share one Groq call.
+# Coalescing needs concurrent callers in one process, so the Celery worker runs with a thread pool (see Procfile).
+MAX_BATCH = 8
+MAX_WAIT_MS = 100
+MAX_BATCH_CHARS = 24000  # Keeps a batched prompt well inside the model's context window
+
+class _AnalysisBatcher:
+    def __init__(self, max_in_flight):
+        self._queue = queue.Queue()
+        # One slot per in-flight Groq call. Entries stay on the queue until a slot frees up, so a backlog
+        # is merged into the next batch instead of waiting in the executor as single-item calls.
+        self._slots = threading.Semaphore(max_in_flight)
+        # Extra headroom for per-transcript fallbacks fanned out from a failed batch (they don't take slots)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight * MAX_BATCH)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._active = 0
+
+    def submit(self, transcript):
+        future = Future()
+        with self._lock:
+            self._active += 1
+        future.add_done_callback(self._on_done)
+        self._ensure_started()
+        self._queue.put((transcript, future))
+        return future
+
+    def _on_done(self, future):
+        with self._lock:
+            self._active -= 1
+
+    def _ensure_started(self):
+        # Started lazily so each forked worker process gets its own consumer thread
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._slots.acquire()
+            entries = [self._queue.get()]
+            deadline = time.monotonic() + MAX_WAIT_MS / 1000
+
+            while len(entries) < MAX_BATCH:
+                # Only wait for more work while other analyses are in flight; a lone request goes out immediately
+                remaining = deadline - time.monotonic() if self._active > len(entries) else 0
+                try:
+                    if remaining <= 0:
+                        entries.append(self._queue.get_nowait())
+                    else:
+                        entries.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            for i, bucket in enumerate(self._bucket_by_size(entries)):
+                if i:
+                    self._slots.acquire()
+                self._executor.submit(self._process, bucket)
+
+    @staticmethod
+    def _bucket_by_size(entries):
+        # Group similar-length transcripts so no single prompt exceeds the character budget
+        buckets = []
+        current = []
+        current_chars = 0
+
+        for entry in sorted(entries, key=lambda e: _windowed_len(e[0])):
+            if current and current_chars + _windowed_len(entry[0]) > MAX_BATCH_CHARS:
+                buckets.append(current)
+                current = []
+                current_chars = 0
+            current.append(entry)
+            current_chars += _windowed_len(entry[0])
+
+        if current:
+            buckets.append(current)
+
+        return buckets
+
+    def _process(self, bucket):
+        try:
+            if len(bucket) > 1:
+                try:
+                    results = _analyze_many([transcript for transcript, _ in bucket])
+                    for (_, future), result in zip(bucket, results):
+                        future.set_result(result)
+                    return
+                except (KeyError, TypeError, ValueError, BadRequestError, RateLimitError) as e:
+                    # Unparseable output, JSON validation failures and rate limits on the shared call
+                    # shouldn't fail every request in the bucket; each transcript gets its own attempt
+                    print(f"Batched call failed ({str(e)}), analyzing transcripts individually")
+                except Exception as e:
+                    for _, future in bucket:
+                        future.set_exception(e)
+                    return
+
+                # Fan the fallbacks out so they run concurrently rather than one after another
+                for transcript, future in bucket[1:]:
+                    self._executor.submit(self._analyze_one, transcript, future)
+                bucket = bucket[:1]
+
+            for transcript, future in bucket:
+                self._analyze_one(transcript, future)
+        finally:
+            self._slots.release()
+
+    @staticmethod
+    def _analyze_one(transcript, future):
+        try:
+            future.set_result(_analyze_single(transcript))
+        except Exception as e:
+            future.set_exception(e)
+
+_batcher = _AnalysisBatcher(WORKER_CONCURRENCY)
+
+# In-process LRU keyed only by the SHA-256, so cached entries never pin the (up to 16MB) transcript in memory
+ANALYSIS_LRU_SIZE = 1024
+_analysis_lru = OrderedDict()
+_analysis_lru_lock = threading.Lock()
+
+def _remember_analysis(transcript_hash, result):
+    with _analysis_lru_lock:
+        _analysis_lru[transcript_hash] = result
+        _analysis_lru.move_to_end(transcript_hash)
+        if len(_analysis_lru) > ANALYSIS_LRU_SIZE:
+            _analysis_lru.popitem(last=False)
+
+def _analyze_cached(transcript_hash, transcript):
+    # Errors propagate as exceptions so they are never cached
+    with _analysis_lru_lock:
+        if transcript_hash in _analysis_lru:
+            _analysis_lru.move_to_end(transcript_hash)
+            print("Analysis cache hit")
+            return _analysis_lru[transcript_hash]
+
+    cache_key = f"an:{transcript_hash}"
+
+    if analysis_cache is not None:
+        try:
+            cached = analysis_cache.get(cache_key)
+            if cached:
+                print("Analysis cache hit")
+                result = tuple(json.loads(cached))
+                _remember_analysis(transcript_hash, result)
+                return result
+        except redis.RedisError as e:
+            print(f"Error reading analysis cache: {str(e)}")
+
+    result = _batcher.submit(transcript).result()
+    _remember_analysis(transcript_hash, result)
+
+    if analysis_cache is not None:
+        try:
+            analysis_cache.setex(cache_key, ANALYSIS_CACHE_TTL, json.dumps(list(result)))
+        except redis.RedisError as e:
+            print(f"Error writing analysis cache: {str(e)}")
+
+    return result
 
-        # Take only the first meaningful phrase
-        sentiment_parts = sentiment_clean.split('.')
-        if len(sentiment_parts) > 1:
-            sentiment_clean = sentiment_parts[0].strip()
+def analyze_transcript(transcript):
+    try:
+        # Check if client is available
+        if not clients:
+            print("Error: Groq client not initialized")
+            return "Error: Groq client not initialized", "Error: Groq client not initialized"
 
-        print(f"Sentiment analyzed: '{sentiment}' -> cleaned: '{sentiment_clean}'")
+        print("Starting transcript analysis...")
 
-        return summary, sentiment_clean
+        # Identical transcripts are served from cache and skip the LLM entirely
+        transcript_hash = hashlib.sha256(transcript.encode('utf-8')).hexdigest()
+        return _analyze_cached(transcript_hash, transcript)
 
     except Exception as e:
         error_msg = f"Error in analysis: {str(e)}"
         print(error_msg)
         return f"Error generating summary: {str(e)}", f"Error analyzing sentiment: {str(e)}"
 
-def save_to_csv(transcript, summary, sentiment):
-    filename = 'call_analysis.csv'
+_CSV_CLEAN_TABLE = str.maketrans({'\n': ' ', '\r': ' ', '"': None})
+
+# The history file is opened once per process and reused for every save
+_csv_lock = threading.Lock()
+_csv_fh = None
+_csv_writer = None
+
+def _is_same_file(fh, filename):
+    try:
+        path_stat = os.stat(filename)
+    except FileNotFoundError:
+        return False
+    open_stat = os.fstat(fh.fileno())
+    return (open_stat.st_dev, open_stat.st_ino) == (path_stat.st_dev, path_stat.st_ino)
+
+def _get_csv_writer(filename):
+    # Caller must hold _csv_lock
+    global _csv_fh, _csv_writer
+
+    # Reopen if the path no longer points at the file we hold open (deleted, or deleted and recreated,
+    # e.g. by /download-csv), so writes aren't lost to an unlinked inode
+    if _csv_fh is None or not _is_same_file(_csv_fh, filename):
+        if _csv_fh is not None:
+            _csv_fh.close()
 
-    # Clean the data by replacing newlines with spaces and removing quotes
-    clean_transcript = transcript.replace('\n', ' ').replace('\r', ' ').replace('"', '').strip()
-    clean_summary = summary.replace('\n', ' ').replace('\r', ' ').replace('"', '').strip()
-    clean_sentiment = sentiment.replace('\n', ' ').replace('\r', ' ').replace('"', '').strip()
+        _csv_fh = open(filename, 'a', newline='', encoding='utf-8', buffering=1)
+
+        # Append so history is preserved; the header is only written to a new or empty file
+        write_header = os.fstat(_csv_fh.fileno()).st_size == 0
 
-    # Always create a fresh CSV file (overwrite mode 'w' instead of append 'a')
-    with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
         fieldnames = ['Transcript', 'Summary', 'Sentiment']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, quoting=csv.QUOTE_MINIMAL)
+        _csv_writer = csv.DictWriter(_csv_fh, fieldnames=fieldnames, quoting=csv.QUOTE_MINIMAL)
+
+        if write_header:
+            _csv_writer.writeheader()
+
+    return _csv_writer
+
+def save_to_csv(transcript, summary, sentiment):
+    filename = 'call_analysis.csv'
 
-        # Write header
-        writer.writeheader()
+    # Clean the data by replacing newlines with spaces and removing quotes (single pass per field)
+    clean_transcript = transcript.translate(_CSV_CLEAN_TABLE).strip()
+    clean_summary = summary.translate(_CSV_CLEAN_TABLE).strip()
+    clean_sentiment = sentiment.translate(_CSV_CLEAN_TABLE).strip()
 
-        # Write the single row of data
+    with _csv_lock:
+        writer = _get_csv_writer(filename)
         writer.writerow({
             'Transcript': clean_transcript,
             'Summary': clean_summary,
             'Sentiment': clean_sentiment
         })
+        _csv_fh.flush()
+
+    print(f"Appended to CSV: {clean_transcript[:50]}... | {clean_summary[:50]}... | {clean_sentiment}")
 
-    print(f"Fresh CSV created with data: {clean_transcript[:50]}... | {clean_summary[:50]}... | {clean_sentiment}")
+@celery.task(name='analyze_task')
+def analyze_task(transcript):
+    summary, sentiment = analyze_transcript(transcript)
+
+    # Only save to CSV if analysis was successful (no errors)
+    if not (summary.startswith("Error") or sentiment.startswith("Error")):
+        save_to_csv(transcript, summary, sentiment)
+    else:
+        print("Skipping CSV save due to analysis errors")
+
+    return {
+        'transcript': transcript,
+        'summary': summary,
+        'sentiment': sentiment
+    }
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+# Keys checked, in priority order, for the transcript text in an uploaded JSON object
+TRANSCRIPT_KEYS = ('transcript', 'conversation', 'dialogue', 'text')
+
 def parse_json_transcript(json_content):
+    # Accepts either bytes or str; invalid UTF-8 is reported as a JSONDecodeError
     try:
-        data = json.loads(json_content)
+        data = orjson.loads(json_content)
 
         if isinstance(data, dict):
-            if 'transcript' in data:
-                return data['transcript']
-            elif 'conversation' in data:
-                return data['conversation']
-            elif 'dialogue' in data:
-                return data['dialogue']
-            elif 'text' in data:
-                return data['text']
-            else:
-                return str(data)
+            for key in TRANSCRIPT_KEYS:
+                if key in data:
+                    return data[key]
+            return str(data)
         elif isinstance(data, list):
-            return ' '.join([str(item) for item in data])
+            return ' '.join(map(str, data))
         else:
             return str(data)
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         return None
 
 @app.route('/analyze', methods=['POST'])
@@ -175,8 +579,8 @@ def analyze():
             file = request.files['json_file']
             if file and file.filename.endswith('.json'):
                 try:
-                    json_content = file.read().decode('utf-8')
-                    transcript = parse_json_transcript(json_content)
+                    # orjson parses the UTF-8 bytes directly, so the upload is never copied into a str
+                    transcript = parse_json_transcript(file.stream.read())
                     if not transcript:
                         flash('Invalid JSON format. Please check your file.', 'error')
                         return redirect(url_for('index'))
@@ -194,21 +598,22 @@ def analyze():
             flash('Please enter a transcript or upload a JSON file to analyze.', 'error')
             return redirect(url_for('index'))
 
-        summary, sentiment = analyze_transcript(transcript)
+        task = analyze_task.delay(transcript)
 
-        # Only save to CSV if analysis was successful (no errors)
-        if not (summary.startswith("Error") or sentiment.startswith("Error")):
-            save_to_csv(transcript, summary, sentiment)
-        else:
-            print("Skipping CSV save due to analysis errors")
+        return redirect(url_for('analysis_result', task_id=task.id))
+
+@app.route('/result/<task_id>')
+def analysis_result(task_id):
+    task = AsyncResult(task_id, app=celery)
 
-        result = {
-            'transcript': transcript,
-            'summary': summary,
-            'sentiment': sentiment
-        }
+    if not task.ready():
+        return render_template('pending.html', task_id=task_id)
+
+    if task.failed():
+        flash(f'Error analyzing transcript: {str(task.result)}', 'error')
+        return redirect(url_for('index'))
 
-        return render_template('result.html', result=result)
+    return render_template('result.html', result=task.result)
 
 @app.route('/api/analyze', methods=['POST'])
 def api_analyze():
@@ -222,34 +627,216 @@ def api_analyze():
     if not transcript:
         return jsonify({'error': 'Empty transcript provided'}), 400
 
-    summary, sentiment = analyze_transcript(transcript)
+    task = analyze_task.delay(transcript)
 
-    # Only save to CSV if analysis was successful (no errors)
-    if not (summary.startswith("Error") or sentiment.startswith("Error")):
-        save_to_csv(transcript, summary, sentiment)
-    else:
-        print("Skipping CSV save due to analysis errors")
+    return jsonify({
+        'task_id': task.id,
+        'status_url': url_for('api_result', task_id=task.id),
+        'status': 'pending'
+    }), 202
+
+@app.route('/api/result/<task_id>')
+def api_result(task_id):
+    task = AsyncResult(task_id, app=celery)
+
+    if not task.ready():
+        return jsonify({'task_id': task_id, 'status': 'pending'})
+
+    if task.failed():
+        return jsonify({'task_id': task_id, 'error': str(task.result), 'status': 'error'}), 500
+
+    result = task.get(timeout=0)
 
     return jsonify({
-        'transcript': transcript,
-        'summary': summary,
-        'sentiment': sentiment,
+        'task_id': task_id,
+        'transcript': result['transcript'],
+        'summary': result['summary'],
+        'sentiment': result['sentiment'],
         'status': 'success'
     })
 
+BATCH_TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+@app.route('/api/analyze_batch', methods=['POST'])
+def api_analyze_batch():
+    if not clients:
+        return jsonify({'error': 'Groq client not initialized'}), 503
+
+    # Batches and their files belong to the key that created them, so always use the first key
+    client = clients[0]
+
+    data = request.get_json()
+
+    if not data or not isinstance(data.get('transcripts'), list):
+        return jsonify({'error': 'No transcripts provided'}), 400
+
+    if not all(isinstance(t, str) for t in data['transcripts']):
+        return jsonify({'error': 'Each transcript must be a string'}), 400
+
+    transcripts = [t.strip() for t in data['transcripts']]
+
+    if not transcripts or not all(transcripts):
+        return jsonify({'error': 'Empty transcript provided'}), 400
+
+    # One JSONL line per transcript, each carrying the combined summary+sentiment request
+    lines = [
+        json.dumps({
+            'custom_id': str(i),
+            'method': 'POST',
+            'url': '/v1/chat/completions',
+            'body': _combined_request_body(transcript)
+        })
+        for i, transcript in enumerate(transcripts)
+    ]
+
+    try:
+        batch_file = client.files.create(
+            file=('call_analysis_batch.jsonl', '\n'.join(lines).encode('utf-8')),
+            purpose='batch'
+        )
+        batch = client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint='/v1/chat/completions',
+            completion_window='24h'
+        )
+    except Exception as e:
+        print(f"Error submitting batch: {str(e)}")
+        return jsonify({'error': f'Error submitting batch: {str(e)}'}), 502
+
+    print(f"Submitted batch {batch.id} with {len(transcripts)} transcripts")
+
+    return jsonify({
+        'batch_id': batch.id,
+        'count': len(transcripts),
+        'status_url': url_for('api_batch_status', batch_id=batch.id),
+        'status': batch.status
+    }), 202
+
+@app.route('/api/batch_status/<batch_id>')
+def api_batch_status(batch_id):
+    if not clients:
+        return jsonify({'error': 'Groq client not initialized'}), 503
+
+    # Batches and their files belong to the key that created them, so always use the first key
+    client = clients[0]
+
+    try:
+        batch = client.batches.retrieve(batch_id)
+    except Exception as e:
+        return jsonify({'error': f'Error retrieving batch: {str(e)}'}), 502
+
+    if batch.status not in BATCH_TERMINAL_STATUSES:
+        return jsonify({'batch_id': batch_id, 'status': batch.status})
+
+    # Successful requests land in the output file and failed ones in the error file
+    lines = []
+    try:
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                lines.extend(client.files.content(file_id).read().decode('utf-8').splitlines())
+    except Exception as e:
+        return jsonify({'error': f'Error downloading batch results: {str(e)}'}), 502
+
+    results = {}
+    for line in lines:
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        result = {'id': int(item['custom_id'])}
+        try:
+            body = item['response']['body']
+            result['summary'], result['sentiment'] = _parse_combined(body['choices'][0]['message']['content'])
+        except (KeyError, TypeError, IndexError, ValueError):
+            error = item.get('error') or ((item.get('response') or {}).get('body') or {}).get('error')
+            result['error'] = str(error or 'Invalid response')
+        results[result['id']] = result
+
+    # Every submitted transcript gets an entry, even if Groq returned nothing for it
+    total = batch.request_counts.total if batch.request_counts else 0
+    for i in range(max(total, len(results))):
+        results.setdefault(i, {'id': i, 'error': 'No result returned'})
+
+    return jsonify({
+        'batch_id': batch_id,
+        'status': batch.status,
+        'results': [results[i] for i in sorted(results)]
+    })
+
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+def _read_csv_tail(filename, skip, count):
+    # Reads backwards in 64KB blocks, skipping the newest `skip` rows and keeping the next `count`.
+    # Skipped rows are only counted, so memory is O(count + block) regardless of page number or file size.
+    # Rows are single-line because save_to_csv strips newlines; split on b'\n' only, since splitlines()
+    # would also break rows on characters like \x0c or \u2028 that save_to_csv leaves in place.
+    # Returns the lines newest first, and whether older rows remain in the file.
+    lines = []
+    skipped = 0
+
+    with open(filename, 'rb') as f:
+        pos = f.seek(0, os.SEEK_END)
+        carry = b''  # Start of a row that continues past the block boundary
+
+        while pos > 0:
+            step = min(65536, pos)
+            pos -= step
+            f.seek(pos)
+            pieces = (f.read(step) + carry).split(b'\n')
+
+            # The first piece may be partial; at the start of the file it is the header instead
+            carry = pieces[0]
+
+            for piece in reversed(pieces[1:]):
+                line = piece.rstrip(b'\r')  # csv writes '\r\n' terminators
+                if not line:
+                    continue
+                if skipped < skip:
+                    skipped += 1
+                elif len(lines) < count:
+                    lines.append(line.decode('utf-8', errors='replace'))
+                else:
+                    return lines, True
+
+    return lines, False
+
 @app.route('/history')
 def history():
     filename = 'call_analysis.csv'
 
-    if not os.path.isfile(filename):
-        return render_template('history.html', records=[])
+    page = max(request.args.get('page', 1, type=int), 1)
+    size = min(max(request.args.get('size', HISTORY_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE)
 
-    records = []
-    with open(filename, 'r', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
-        records = list(reader)
+    empty_counts = {'positive': 0, 'neutral': 0, 'negative': 0}
 
-    return render_template('history.html', records=records)
+    if not os.path.isfile(filename):
+        return render_template('history.html', records=[], page=page, size=size, has_next=False,
+                               sentiment_counts=empty_counts)
+
+    with open(filename, 'r', newline='', encoding='utf-8') as csvfile:
+        fieldnames = next(csv.reader(csvfile), None)
+
+    if not fieldnames:
+        return render_template('history.html', records=[], page=page, size=size, has_next=False,
+                               sentiment_counts=empty_counts)
+
+    # Only the tail of the file needed for this page is read, newest records first
+    lines, has_next = _read_csv_tail(filename, (page - 1) * size, size)
+    records = [dict(zip(fieldnames, row)) for row in csv.reader(lines)]
+
+    # Per-page counts, bucketed the same way the template colors each record
+    sentiment_counts = dict(empty_counts)
+    for record in records:
+        sentiment_lower = record.get('Sentiment', '').lower()
+        if 'positive' in sentiment_lower:
+            sentiment_counts['positive'] += 1
+        elif 'negative' in sentiment_lower:
+            sentiment_counts['negative'] += 1
+        else:
+            sentiment_counts['neutral'] += 1
+
+    return render_template('history.html', records=records, page=page, size=size, has_next=has_next,
+                           sentiment_counts=sentiment_counts)
 
 @app.route('/download-csv')
 def download_csv():
@@ -265,16 +852,29 @@ def download_csv():
         flash('No analysis data found. Please analyze a transcript first.', 'error')
         return redirect(url_for('index'))
 
+    # Open (and read the first chunk) up front so failures can still redirect before headers are sent
     try:
-        return send_file(
-            filename,
-            mimetype='text/csv',
-            as_attachment=True,
-            download_name='call_analysis.csv'
-        )
+        csvfile = open(filename, 'rb')
+        first_chunk = csvfile.read(65536)
     except Exception as e:
         flash(f'Error downloading CSV: {str(e)}', 'error')
         return redirect(url_for('history'))
 
+    def generate(csvfile, chunk):
+        # Stream in fixed-size chunks so memory use doesn't grow with the history file
+        with csvfile:
+            while chunk:
+                yield chunk
+                chunk = csvfile.read(65536)
+
+    return Response(
+        generate(csvfile, first_chunk),
+        mimetype='text/csv',
+        headers={'Content-Disposition': 'attachment; filename=call_analysis.csv'}
+    )
+
+# ASGI entry point for asyncio servers, e.g. `uvicorn app:asgi_app`
+asgi_app = WsgiToAsgi(app)
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file